@@ -0,0 +1,96 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Compiled fast path for master_preprocess on ASCII input.
+# Same steps as the Python version: recursive URL decode (up to 3 passes),
+# lowercase, whitespace collapse + strip. Returns None whenever the result
+# could differ from the str-based version (non-ASCII bytes, before or after
+# decoding) so the caller falls back to pure Python.
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+
+
+cdef inline int _hex(unsigned char c) noexcept nogil:
+    if c >= 48 and c <= 57:    # 0-9
+        return c - 48
+    if c >= 97 and c <= 102:   # a-f
+        return c - 87
+    if c >= 65 and c <= 70:    # A-F
+        return c - 55
+    return -1
+
+
+cdef inline bint _is_space(unsigned char c) noexcept nogil:
+    # ASCII chars matched by \s / str.isspace(): \t \n \v \f \r, \x1c-\x1f, space
+    return (c >= 9 and c <= 13) or (c >= 28 and c <= 32)
+
+
+cpdef bytes preprocess(const unsigned char[:] s):
+    cdef Py_ssize_t n = s.shape[0]
+    cdef Py_ssize_t i, j, out_len
+    cdef int hi, lo, value, passes
+    cdef bint changed, pending_space
+    cdef unsigned char c
+    cdef unsigned char* buf
+    cdef bytes result
+
+    if n == 0:
+        return b""
+
+    buf = <unsigned char*>malloc(n)
+    if buf == NULL:
+        raise MemoryError()
+
+    try:
+        for i in range(n):
+            if s[i] >= 128:
+                return None
+        memcpy(buf, &s[0], n)
+
+        # A. Recursive Decode (Up to 3 times), in place
+        for passes in range(3):
+            changed = False
+            j = 0
+            i = 0
+            while i < n:
+                c = buf[i]
+                if c == 37 and i + 2 < n:   # '%'
+                    hi = _hex(buf[i + 1])
+                    lo = _hex(buf[i + 2])
+                    if hi >= 0 and lo >= 0:
+                        value = hi * 16 + lo
+                        if value >= 128:
+                            return None
+                        buf[j] = <unsigned char>value
+                        j += 1
+                        i += 3
+                        changed = True
+                        continue
+                buf[j] = c
+                j += 1
+                i += 1
+            n = j
+            if not changed:
+                break
+
+        # B. Lowercase + C. Space Canonicalization, in place
+        out_len = 0
+        pending_space = False
+        for i in range(n):
+            c = buf[i]
+            if _is_space(c):
+                pending_space = out_len > 0
+                continue
+            if pending_space:
+                buf[out_len] = 32
+                out_len += 1
+                pending_space = False
+            if c >= 65 and c <= 90:
+                c += 32
+            buf[out_len] = c
+            out_len += 1
+
+        result = PyBytes_FromStringAndSize(<char*>buf, out_len)
+        return result
+    finally:
+        free(buf)
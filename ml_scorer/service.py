@@ -1,154 +1,319 @@
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Response
+import msgspec
+import asyncio
+import concurrent.futures
 import joblib
+import numpy as np
+import itertools
 import os
 import urllib.parse
 import re
 import json
 import psutil
 import time
+import threading
+from collections import deque
+from typing import Any
 
 app = FastAPI()
 MODEL_PATH = "waf_model.pkl"
 model = None
+model_classes = None
+
+# CPU-bound parsing/inference runs here so the event loop stays free between arrivals.
+# Sized per Uvicorn worker (WORKERS, see start.sh) so all workers together use ~1 thread per CPU.
+WORKERS = max(1, int(os.environ.get("WORKERS", "1")))
+INFERENCE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // WORKERS))
+
+# Cross-request micro-batching: requests queued while an inference runs are merged
+# (up to BATCH_MAX_REQUESTS) into the next one; a lone request never waits.
+BATCH_MAX_REQUESTS = 64
+batch_queue = None
+batch_task = None
+
+# Prediction cache keyed by preprocessed content (FIFO eviction).
+# Only header-sized values are cached: they are what repeats, and the cap bounds
+# worst-case key memory to ~25 MB per worker even under deliberate cache filling.
+PREDICTION_CACHE_SIZE = 100_000
+PREDICTION_CACHE_MAX_KEY_LEN = 256
+prediction_cache = {}
+prediction_cache_order = deque()
+prediction_cache_lock = threading.Lock()
 
 # Stats tracking
+# next() on itertools.count is atomic under the GIL, unlike `request_count += 1`
+request_counter = itertools.count(1)
 request_count = 0
-start_time = time.time()
+start_time = time.monotonic()
 
 # --- 1. Master Preprocessor ---
+# Optional compiled fast path (python setup.py build_ext --inplace); pure Python otherwise
+try:
+    from _fastpre import preprocess as fast_preprocess
+except ImportError:
+    fast_preprocess = None
+
+_PCT_RE = re.compile(r'%[0-9A-Fa-f]{2}')
+_WS_RE = re.compile(r'\s+')
+
 def master_preprocess(text):
     if not isinstance(text, str) or not text:
         return ""
+    if fast_preprocess is not None and text.isascii():
+        result = fast_preprocess(text.encode("ascii"))
+        if result is not None:
+            return result.decode("ascii")
     
+    # Most components carry no percent-encoding: skip the unquote passes entirely.
     decoded = text
-    for _ in range(3):
-        try:
+    if _PCT_RE.search(decoded):
+        for _ in range(3):
             temp = urllib.parse.unquote(decoded)
             if temp == decoded: break
             decoded = temp
-        except: break
     
     decoded = decoded.lower()
-    decoded = re.sub(r'\s+', ' ', decoded).strip()
-    return decoded
+    if not _WS_RE.search(decoded):
+        return decoded
+    return _WS_RE.sub(' ', decoded).strip()
 
 # --- 2. Deep Payload Parser ---
+_SKIP_HEADERS = frozenset({
+    # 1. Standard noisy headers
+    "host", "accept", "connection", "accept-encoding", "accept-language", "content-length", "upgrade-insecure-requests",
+    # 2. Cache/Priority
+    "priority", "cache-control", "pragma"
+})
+_SKIP_HEADER_PREFIXES = (
+    # Browser Fingerprinting Headers (Save CPU & reduce noise)
+    "sec-ch-ua", "sec-fetch",
+    # Cloudflare Fingerprinting Headers (Save CPU & reduce noise)
+    "cf-", "cdn-"
+)
+_JSON_HEAD_RE = re.compile(r'\s*[\[{]')
+
+def walk_json(root):
+    # Iterative walk (no frame per nesting level); yields (source, raw value)
+    queue = deque([("Body", root)])
+    while queue:
+        prefix, data = queue.popleft()
+        for k, v in data.items():
+            if isinstance(v, dict):
+                queue.append((f"{prefix}.{k}", v))
+            elif isinstance(v, list):
+                for item in v:
+                    if isinstance(item, (str, int, float)):
+                        yield f"{prefix}: {k}[]", str(item)
+            else:
+                yield f"{prefix}: {k}", str(v)
+
 def dissect_payload(path, body, headers):
+    # Maps source -> (lowercased source, preprocessed content)
     components = {}
     
     # A. Path Analysis
     if path:
-        components["URL Full"] = master_preprocess(path)
+        components["URL Full"] = ("url full", master_preprocess(path))
         try:
             parsed = urllib.parse.urlparse(path)
-            if parsed.query:
-                components["URL Raw Query"] = master_preprocess(parsed.query)
-            segments = parsed.path.strip("/").split("/")
+            query = parsed.query
+            if query:
+                components["URL Raw Query"] = ("url raw query", master_preprocess(query))
+            segments = [segment for segment in parsed.path.split("/") if segment]
             for i, segment in enumerate(segments):
-                if segment:
-                    components[f"URL Segment {i+1}"] = master_preprocess(segment)
-            query_params = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
-            for k, values in query_params.items():
-                for v in values:
-                    components[f"URL Param: {k}"] = master_preprocess(v)
+                components[f"URL Segment {i+1}"] = (f"url segment {i+1}", master_preprocess(segment))
+            # Most paths carry no query string: skip parse_qs entirely
+            if query:
+                for k, values in urllib.parse.parse_qs(query, keep_blank_values=True).items():
+                    for v in values:
+                        components[f"URL Param: {k}"] = (f"url param: {k.lower()}", master_preprocess(v))
         except:
             pass
 
     # B. Body Analysis
     if body:
-        components["Body Raw"] = master_preprocess(body)
-        try:
-            json_data = json.loads(body)
-            if isinstance(json_data, dict):
-                def inspect_json(data, prefix="Body"):
-                    for k, v in data.items():
-                        if isinstance(v, dict):
-                            inspect_json(v, prefix=f"{prefix}.{k}")
-                        elif isinstance(v, list):
-                            for item in v:
-                                if isinstance(item, (str, int, float)):
-                                    components[f"{prefix}: {k}[]"] = master_preprocess(str(item))
-                        else:
-                            components[f"{prefix}: {k}"] = master_preprocess(str(v))
-                inspect_json(json_data)
-                return components 
-        except:
-            pass
+        components["Body Raw"] = ("body raw", master_preprocess(body))
+        # Pick the parser from the first non-whitespace char instead of trying both
+        is_json = False
+        if _JSON_HEAD_RE.match(body):
+            try:
+                json_data = json.loads(body)
+                is_json = True
+                if isinstance(json_data, dict):
+                    components.update({
+                        source: (source.lower(), master_preprocess(value))
+                        for source, value in walk_json(json_data)
+                    })
+                    return components 
+            except:
+                pass
             
-        try:
-            form_data = urllib.parse.parse_qs(body, keep_blank_values=True)
-            if form_data:
-                for k, values in form_data.items():
-                    for v in values:
-                        components[f"Body Form: {k}"] = master_preprocess(v)
-        except:
-            pass
+        # Without any "=" every form value is blank, so there is nothing to inspect
+        if not is_json and "=" in body:
+            try:
+                form_data = urllib.parse.parse_qs(body, keep_blank_values=True)
+                if form_data:
+                    for k, values in form_data.items():
+                        for v in values:
+                            components[f"Body Form: {k}"] = (f"body form: {k.lower()}", master_preprocess(v))
+            except:
+                pass
 
     # C. Header Analysis
     if headers:
         for k, v in headers.items():
             key_lower = k.lower()
             
-            # 1. Skip standard noisy headers
-            if key_lower in ["host", "accept", "connection", "accept-encoding", "accept-language", "content-length", "upgrade-insecure-requests"]:
+            # Skip noisy, fingerprinting and cache headers in one set lookup + one prefix check
+            if key_lower in _SKIP_HEADERS or key_lower.startswith(_SKIP_HEADER_PREFIXES):
                 continue
-            
-            # 2. Skip Browser Fingerprinting Headers (Save CPU & reduce noise)
-            if key_lower.startswith("sec-ch-ua") or key_lower.startswith("sec-fetch"):
-                continue
-            
-            # 2. Skip Cloudflare Fingerprinting Headers (Save CPU & reduce noise)
-            if key_lower.startswith("cf-") or key_lower.startswith("cdn-"):
-                continue          
 
-            # 3. Skip Cache/Priority
-            if key_lower in ["priority", "cache-control", "pragma"]:
-                continue
-
-            components[f"Header: {k}"] = master_preprocess(v)
+            components[f"Header: {k}"] = (f"header: {key_lower}", master_preprocess(v))
 
     return components
 
 # --- 3. Startup ---
 @app.on_event("startup")
 def load_model():
-    global model
+    global model, model_classes
     if os.path.exists(MODEL_PATH):
         model = joblib.load(MODEL_PATH)
+        model_classes = np.asarray(model.classes_)
+        # The forest is trained with n_jobs=-1; at inference, dispatching request-sized
+        # batches to joblib workers costs more than walking the 100 trees inline.
+        if hasattr(model[-1], "n_jobs"):
+            model[-1].n_jobs = 1
         print(f"✅ ML Model Loaded: {MODEL_PATH}")
     else:
         print(f"❌ Critical: Model not found at {MODEL_PATH}. Check logs.")
 
-class RequestData(BaseModel):
+@app.on_event("startup")
+async def start_batch_worker():
+    global batch_queue, batch_task
+    batch_queue = asyncio.Queue()
+    batch_task = asyncio.create_task(batch_worker())
+
+# msgspec decodes + validates in C, far cheaper than a Pydantic model on every request.
+# strict=False keeps the lax coercion the Pydantic model had ("5" / 5.0 for length);
+# header values stay Any because master_preprocess already ignores non-str values.
+class RequestData(msgspec.Struct):
     path: str
     body: str
     length: int
-    headers: dict = {}
+    headers: dict[str, Any] = {}
+
+request_decoder = msgspec.json.Decoder(RequestData, strict=False)
+response_encoder = msgspec.json.Encoder()
 
 # --- 4. Heuristic Scorer (Generic) ---
+# This penalizes (;), ((), etc. Good for Body/SQL, BAD for User-Agents.
+# Scanned in this order so the float sum matches the original scorer exactly.
+_SUSPICIOUS_TOKENS = [
+    ("'", 0.15), ('"', 0.10), ("<", 0.15), (">", 0.15), (";", 0.10), ("--", 0.20),
+    ("(", 0.05), (")", 0.05), ("$", 0.10), ("`", 0.10), ("union", 0.30), ("select", 0.20),
+    ("{", 0.10), ("}", 0.10)
+]
+
+# Above this length one np.bincount pass beats the per-char str.count scans (large bodies only)
+HISTOGRAM_MIN_LEN = 4096
+
 def calculate_heuristic_score(content):
-    # This penalizes (;), ((), etc. Good for Body/SQL, BAD for User-Agents.
-    suspicious_chars = {
-        "'": 0.15, '"': 0.10, "<": 0.15, ">": 0.15, ";": 0.10, "--": 0.20,
-        "(": 0.05, ")": 0.05, "$": 0.10, "`": 0.10, "union": 0.30, "select": 0.20,
-        "{": 0.10, "}": 0.10
-    }
+    # Content always comes out of master_preprocess, which already lowercases it
     score = 0.0
-    content_lower = content.lower()
-    for char, weight in suspicious_chars.items():
-        if char in content_lower:
-            score += (weight * content_lower.count(char))
+    if len(content) < HISTOGRAM_MIN_LEN:
+        for token, weight in _SUSPICIOUS_TOKENS:
+            if token in content:
+                score += (weight * content.count(token))
+        return min(score, 0.60)
+
+    counts = np.bincount(np.frombuffer(content.encode("utf-8", "ignore"), dtype=np.uint8), minlength=256).tolist()
+    for token, weight in _SUSPICIOUS_TOKENS:
+        count = counts[ord(token)] if len(token) == 1 else content.count(token)
+        if count:
+            score += (weight * count)
     return min(score, 0.60)
 
+# --- 5. Batched ML Inference ---
+def predict_batch(contents):
+    # One predict_proba call for every uncached component of the batch.
+    # The pipeline vectorizes TF-IDF + tree traversal over the whole batch.
+    labels = [None] * len(contents)
+    confidences = [0.0] * len(contents)
+    miss_idx = []
+    miss_contents = []
+    with prediction_cache_lock:
+        for i, content in enumerate(contents):
+            hit = prediction_cache.get(content)
+            if hit is None:
+                miss_idx.append(i)
+                miss_contents.append(content)
+            else:
+                labels[i], confidences[i] = hit
+
+    if not miss_contents:
+        return labels, confidences
+
+    probs = model.predict_proba(miss_contents)
+    idx = probs.argmax(axis=1)
+    miss_labels = model_classes[idx]
+    miss_confidences = probs[np.arange(len(miss_contents)), idx]
+
+    with prediction_cache_lock:
+        for i, content, label, confidence in zip(miss_idx, miss_contents, miss_labels, miss_confidences):
+            result = (str(label), float(confidence))
+            labels[i], confidences[i] = result
+            if len(content) > PREDICTION_CACHE_MAX_KEY_LEN or content in prediction_cache:
+                continue
+            if len(prediction_cache_order) >= PREDICTION_CACHE_SIZE:
+                del prediction_cache[prediction_cache_order.popleft()]
+            prediction_cache[content] = result
+            prediction_cache_order.append(content)
+    return labels, confidences
+
+async def batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        while len(batch) < BATCH_MAX_REQUESTS:
+            try:
+                batch.append(batch_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        merged = []
+        for contents, _ in batch:
+            merged.extend(contents)
+
+        try:
+            labels, confidences = await loop.run_in_executor(INFERENCE_POOL, predict_batch, merged)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        # Slice the merged result back to each waiting request
+        start = 0
+        for contents, future in batch:
+            end = start + len(contents)
+            if not future.done():
+                future.set_result((labels[start:end], confidences[start:end]))
+            start = end
+
+async def enqueue_batch(contents):
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((contents, future))
+    return await future
+
 
 @app.get("/health")
 def health_check():
+    # Stats are per worker process: with WORKERS > 1 each poll reports whichever worker answered.
     process = psutil.Process(os.getpid())
     memory_info = process.memory_info()
     memory_mb = round(memory_info.rss / 1024 / 1024, 2)
     cpu_percent = process.cpu_percent(interval=None)
-    uptime_min = (time.time() - start_time) / 60
+    uptime_min = (time.monotonic() - start_time) / 60
     rpm = int(request_count / uptime_min) if uptime_min > 0 else 0
     
     return {
@@ -159,13 +324,18 @@ def health_check():
     }
 
 @app.post("/predict")
-def predict(data: RequestData):
+async def predict(request: Request):
+    try:
+        data = request_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
     global request_count
-    request_count += 1
+    request_id = request_count = next(request_counter)
     
     # Debug Logs
     print("\n" + "="*40)
-    print(f"📥 RECEIVED REQUEST #{request_count}")
+    print(f"📥 RECEIVED REQUEST #{request_id}")
     print(f"🔹 Path:    {data.path!r}")
     # print(f"🔹 Headers: {data.headers}") # Uncomment if you need deep debugging
     print("="*40 + "\n", flush=True)
@@ -173,15 +343,20 @@ def predict(data: RequestData):
     if not model:
         raise HTTPException(status_code=503, detail="Model not loaded")
 
-    inspectable_items = dissect_payload(data.path, data.body, data.headers)
+    loop = asyncio.get_running_loop()
+    inspectable_items = await loop.run_in_executor(
+        INFERENCE_POOL, dissect_payload, data.path, data.body, data.headers
+    )
     
     max_risk_score = 0.0
     is_anomaly = False
     detected_type = "Normal"
     trigger_content = "" 
 
-    # --- 5. Hybrid Analysis Loop ---
-    for source, content in inspectable_items.items():
+    # --- 6. Collect Unique Inspectable Components ---
+    # URL Full / Raw Query / Segments often carry the same string: score each one once.
+    unique_items = {}
+    for source_lower, content in inspectable_items.values():
         if not content.strip(): continue
         if content.strip() in ["/", "\\"]: continue
         
@@ -191,48 +366,60 @@ def predict(data: RequestData):
         if is_short and is_alphanum:
             continue
 
-        # A. ML Analysis (Always Run)
-        pred_label = model.predict([content])[0]
-        probs = model.predict_proba([content])[0]
-        ml_confidence = probs[list(model.classes_).index(pred_label)]
-        
+        unique_items.setdefault(content, []).append(source_lower)
+
+    contents = list(unique_items)
+
+    # A. ML Analysis (Always Run, merged with concurrent requests)
+    if contents:
+        labels, confidences = await enqueue_batch(contents)
+    else:
+        labels, confidences = [], []
+
+    # --- 7. Hybrid Analysis Loop ---
+    for content, pred_label, ml_confidence in zip(contents, labels, confidences):
         if pred_label == "Normal":
             ml_risk = 1.0 - ml_confidence 
         else:
             ml_risk = ml_confidence
 
-        # B. Conditional Heuristic Scoring
-        heuristic_boost = 0.0
-        
-        if "user-agent" in source.lower():
-            # 🟢 BYPASS: Do NOT run heuristic scorer on User-Agents.
-            # Normal browsers have ";" and "(". 
-            # Bad bots are already blocked by Go Rules.
-            # We trust the ML model alone for subtle UA anomalies.
-            heuristic_boost = 0.0 
-        else:
-            # 🔴 ENFORCE: Run heuristic scorer on Body/Path.
-            # Semicolons here are still suspicious (SQLi).
-            heuristic_boost = calculate_heuristic_score(content)
+        heuristic_score = None
+        for source_lower in unique_items[content]:
+            # B. Conditional Heuristic Scoring
+            heuristic_boost = 0.0
+            
+            if "user-agent" in source_lower:
+                # 🟢 BYPASS: Do NOT run heuristic scorer on User-Agents.
+                # Normal browsers have ";" and "(". 
+                # Bad bots are already blocked by Go Rules.
+                # We trust the ML model alone for subtle UA anomalies.
+                heuristic_boost = 0.0 
+            else:
+                # 🔴 ENFORCE: Run heuristic scorer on Body/Path.
+                # Semicolons here are still suspicious (SQLi).
+                if heuristic_score is None:
+                    heuristic_score = calculate_heuristic_score(content)
+                heuristic_boost = heuristic_score
 
-        # C. Final Calculation
-        final_risk = ml_risk + heuristic_boost
-        if final_risk > 1.0: final_risk = 1.0
+            # C. Final Calculation
+            final_risk = ml_risk + heuristic_boost
+            if final_risk > 1.0: final_risk = 1.0
 
-        if final_risk > 0.75:
-            is_anomaly = True
-        
-        if final_risk > max_risk_score:
-            max_risk_score = final_risk
-            trigger_content = content 
+            if final_risk > 0.75:
+                is_anomaly = True
             
-            if pred_label != "Normal":
-                clean_label = pred_label.replace("malicious(", "").replace(")", "").upper()
-                detected_type = "ML_" + clean_label 
+            if final_risk > max_risk_score:
+                max_risk_score = final_risk
+                trigger_content = content 
+                
+                if pred_label != "Normal":
+                    clean_label = pred_label.replace("malicious(", "").replace(")", "").upper()
+                    detected_type = "ML_" + clean_label 
 
-    return {
+    result = {
         "is_anomaly": is_anomaly,
         "anomaly_score": float(max_risk_score),
         "attack_type": detected_type,
         "trigger_content": trigger_content
-    }
\ No newline at end of file
+    }
+    return Response(content=response_encoder.encode(result), media_type="application/json")
\ No newline at end of file
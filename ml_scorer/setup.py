@@ -0,0 +1,10 @@
+from setuptools import setup
+from Cython.Build import cythonize
+
+# Builds the optional _fastpre extension in place:
+#   python setup.py build_ext --inplace
+# service.py / train.py fall back to pure Python when it is missing.
+setup(
+    name="ml_scorer_fastpre",
+    ext_modules=cythonize(["_fastpre.pyx"], language_level=3),
+)
@@ -3,4 +3,6 @@ if [ ! -f "waf_model.pkl" ]; then
     echo "⚠️ Model not found. Training..."
     python train.py
 fi
-exec uvicorn service:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+# One worker by default: /health stats (req/min, memory) are per process and not aggregated.
+export WORKERS="${WORKERS:-1}"
+exec uvicorn service:app --host 0.0.0.0 --port 8000 --workers "$WORKERS" --loop uvloop --http httptools --no-access-log
\ No newline at end of file
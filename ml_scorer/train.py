@@ -4,6 +4,7 @@ import joblib
 import re
 import urllib.parse
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 # --- 1. Suppress Harmless Warnings ---
 warnings.filterwarnings("ignore", category=UserWarning, module="sklearn.utils.parallel")
@@ -15,36 +16,65 @@ from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report, accuracy_score
 
 # --- 2. Master Preprocessor (Unified Canonicalization) ---
+# Optional compiled fast path (python setup.py build_ext --inplace); pure Python otherwise
+try:
+    from _fastpre import preprocess as fast_preprocess
+except ImportError:
+    fast_preprocess = None
+
+_PCT_RE = re.compile(r'%[0-9A-Fa-f]{2}')
+_WS_RE = re.compile(r'\s+')
+
 def master_preprocess(text):
     """
     Standardizes text to ensure Training Data matches Inference Data.
     1. Recursive URL Decode
     2. Lowercase 
     3. Space Canonicalization (Tabs/Newlines -> Single Space)
+    ASCII input goes through the compiled _fastpre module when it is built.
     """
     if not isinstance(text, str) or not text:
         return ""
+    if fast_preprocess is not None and text.isascii():
+        result = fast_preprocess(text.encode("ascii"))
+        if result is not None:
+            return result.decode("ascii")
     
-    # A. Recursive Decode (Up to 3 times)
+    # A. Recursive Decode (Up to 3 times, only if something is encoded)
     decoded = text
-    for _ in range(3):
-        try:
+    if _PCT_RE.search(decoded):
+        for _ in range(3):
             temp = urllib.parse.unquote(decoded)
             if temp == decoded: break
             decoded = temp
-        except: break
     
     # B. Lowercase
     decoded = decoded.lower()
     
     # C. Space Canonicalization
-    decoded = re.sub(r'\s+', ' ', decoded).strip()
-    
-    return decoded
+    if not _WS_RE.search(decoded):
+        return decoded
+    return _WS_RE.sub(' ', decoded).strip()
+
+def preprocess_file(task):
+    """
+    Reads and preprocesses one data file (runs in a worker process).
+    Returns (label, filepath, lines, error).
+    """
+    label, filepath = task
+    try:
+        with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+            lines = [master_preprocess(line) for line in f if line.strip()]
+        return label, filepath, lines, None
+    except Exception as e:
+        return label, filepath, [], e
 
 def load_data():
     """
     Scans 'data/normal/' and 'data/malicious/' folders.
+    NOTE: the shipped waf_model.pkl also has a 'malicious(headers)' class whose
+    data file is not in data/malicious/; retraining from this tree drops it.
+    Files are preprocessed in parallel, one per worker process.
     Returns X (requests) and y (labels).
     """
     X = []
@@ -56,30 +86,29 @@ def load_data():
 
     print("📂 Loading Payload Data...")
 
-    # 1. Load Normal Data
+    tasks = []
+
+    # 1. Normal Data
     if os.path.exists(normal_dir):
         files = glob.glob(os.path.join(normal_dir, "*.txt"))
         for filepath in files:
-            try:
-                with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-                    lines = [master_preprocess(line) for line in f if line.strip()]
-                    X.extend(lines)
-                    y.extend(["Normal"] * len(lines))
-            except Exception as e:
-                print(f"   ⚠️ Skipped {filepath}: {e}")
-
-    # 2. Load Malicious Data
+            tasks.append(("Normal", filepath))
+
+    # 2. Malicious Data
     if os.path.exists(malicious_dir):
         files = glob.glob(os.path.join(malicious_dir, "*.txt"))
         for filepath in files:
             label = os.path.splitext(os.path.basename(filepath))[0]
-            try:
-                with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-                    lines = [master_preprocess(line) for line in f if line.strip()]
-                    X.extend(lines)
-                    y.extend([label] * len(lines))
-            except Exception as e:
-                print(f"   ⚠️ Skipped {filepath}: {e}")
+            tasks.append((label, filepath))
+
+    # 3. Preprocess in parallel (map keeps file order, so results stay deterministic)
+    with ProcessPoolExecutor() as executor:
+        for label, filepath, lines, error in executor.map(preprocess_file, tasks):
+            if error is not None:
+                print(f"   ⚠️ Skipped {filepath}: {error}")
+                continue
+            X.extend(lines)
+            y.extend([label] * len(lines))
 
     return X, y
 